@@ -441,6 +441,7 @@ class ColorPclGenerator:
         is_lidar=True,
         extrinsics=None,
         rotate_img_180: bool = True,
+        color_scale=None,
     ):
         """
         Generate semantic point cloud to be used to do bayesian fusion
@@ -449,6 +450,9 @@ class ColorPclGenerator:
         \param semantic_colors (list of bgr8 images) semantic colors of different levels of confidences, ordered by confidences (desc)
         \param confidences (a list of numpy array float32) confidence maps of associated semantic colors, ordered by values (desc)
         \stamp (ros time stamp)
+        \param color_scale (tuple(float) or None) (x, y) factors taking image
+            coordinates onto the semantic_colors/confidences grids, which may
+            be lower resolution than the color image. None means same size.
         """
         # TODO check if this is correct
         if rotate_img_180:
@@ -461,6 +465,20 @@ class ColorPclGenerator:
             self.generate_cloud_data_common_img(bgr_img, three_d_data)
 
         # Transform semantic colors
+        if color_scale is not None:
+            # The semantic arrays live on a coarser grid; scale the
+            # projected points once and clip against that grid's extent
+            semantic_points = np.asarray(self.image_points) * np.array(
+                [[color_scale[0]], [color_scale[1]]]
+            )
+            semantic_points = np.minimum(
+                semantic_points,
+                np.array(
+                    [[semantic_colors.shape[2] - 1], [semantic_colors.shape[1] - 1]]
+                ),
+            )
+        else:
+            semantic_points = self.image_points
         num_points_in_image = self.image_points.shape[1]
         self.semantic_colors_vect = np.zeros(
             (num_points_in_image, 4 * self.num_semantic_colors), dtype="<u1"
@@ -474,9 +492,9 @@ class ColorPclGenerator:
             second_channel = semantic_colors[i][:, :, 1]
             third_channel = semantic_colors[i][:, :, 2]
 
-            sampled_first_channel = sample_points(first_channel, self.image_points)
-            sampled_second_channel = sample_points(second_channel, self.image_points)
-            sampled_third_channel = sample_points(third_channel, self.image_points)
+            sampled_first_channel = sample_points(first_channel, semantic_points)
+            sampled_second_channel = sample_points(second_channel, semantic_points)
+            sampled_third_channel = sample_points(third_channel, semantic_points)
 
             self.semantic_colors_vect[:, 4 * i] = sampled_first_channel
             self.semantic_colors_vect[:, 4 * i + 1] = sampled_second_channel
@@ -484,7 +502,7 @@ class ColorPclGenerator:
 
         # Transform class confidence
         for i in range(self.num_semantic_colors):
-            sampled_confidence = sample_points(confidences[i], self.image_points)
+            sampled_confidence = sample_points(confidences[i], semantic_points)
             self.confidences_vect[:, i] = sampled_confidence
 
         # TODO fill only the number of points that are present
@@ -0,0 +1,189 @@
+"""
+Optional TensorRT backend for the semantic segmentation CNN
+Wraps a serialized engine (exported from the mmseg model via mmdeploy/ONNX,
+typically with fp16 enabled) behind a callable with the same output layout
+as inference_segmentor: per-class probabilities as a (h, w, c) numpy array.
+\author David Russell
+\date 2022 -
+"""
+
+from __future__ import division, print_function
+
+import cv2
+import mmcv
+import numpy as np
+import torch
+
+try:
+    import tensorrt as trt
+
+    TRT_AVAILABLE = True
+except ImportError:
+    TRT_AVAILABLE = False
+
+# TensorRT binding dtypes we know how to back with torch buffers
+_TORCH_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "int32": torch.int32,
+}
+
+
+def _find_normalize(pipeline):
+    """
+    Find the Normalize step in an mmseg test pipeline
+    \param pipeline (list of dict) pipeline steps, possibly nested inside
+        wrappers such as MultiScaleFlipAug
+    \return (dict) the Normalize step, or None if the pipeline has none
+    """
+    for step in pipeline:
+        if step.get("type") == "Normalize":
+            return step
+        if "transforms" in step:
+            found = _find_normalize(step["transforms"])
+            if found is not None:
+                return found
+    return None
+
+
+class TRTSegmentor:
+    """
+    Run a serialized TensorRT engine as a drop-in segmentor
+    \param engine_path (str) path to the serialized .engine/.trt file
+    \param config_path (str) the mmseg config the engine was exported from,
+        used to replicate the test pipeline's normalization
+    \param device (str) cuda device string, e.g. "cuda:0"
+
+    The engine does not embed the mmseg test pipeline, so the input is
+    resized to the engine binding shape and normalized with the config's
+    mean/std/to_rgb here. Host (pinned) and device buffers are allocated
+    once from the engine bindings, and every call reuses them with async
+    copies on a private stream, so there are no per-frame allocations.
+    """
+
+    def __init__(self, engine_path, config_path, device="cuda:0"):
+        if not TRT_AVAILABLE:
+            raise ImportError(
+                "tensorrt is not installed but a TensorRT engine was requested"
+            )
+        self.device = torch.device(device)
+        self.logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, "rb") as engine_file, trt.Runtime(
+            self.logger
+        ) as runtime:
+            self.engine = runtime.deserialize_cuda_engine(engine_file.read())
+        self.context = self.engine.create_execution_context()
+        self.stream = torch.cuda.Stream(device=self.device)
+
+        # Replicate the normalization the mmseg test pipeline would apply
+        cfg = mmcv.Config.fromfile(config_path)
+        norm = _find_normalize(cfg.data.test.pipeline)
+        if norm is None:
+            raise ValueError(
+                f"No Normalize step found in the test pipeline of {config_path};"
+                " cannot replicate the model's preprocessing"
+            )
+        self._mean = np.asarray(norm["mean"], dtype=np.float32)
+        self._std = np.asarray(norm["std"], dtype=np.float32)
+        self._to_rgb = bool(norm.get("to_rgb", True))
+
+        # Allocate one pinned host + device buffer pair per binding
+        self._device_buffers = []
+        self._input_index = None
+        self._output_index = None
+        for i in range(self.engine.num_bindings):
+            shape = tuple(self.engine.get_binding_shape(i))
+            np_dtype = np.dtype(trt.nptype(self.engine.get_binding_dtype(i)))
+            torch_dtype = _TORCH_DTYPES[np_dtype.name]
+            self._device_buffers.append(
+                torch.empty(shape, dtype=torch_dtype, device=self.device)
+            )
+            if self.engine.binding_is_input(i):
+                if len(shape) != 4 or shape[0] != 1 or shape[1] != 3:
+                    raise ValueError(
+                        f"Engine input binding has shape {shape}; expected a"
+                        " static (1, 3, height, width) image binding"
+                    )
+                self._input_index = i
+                # (height, width) the engine expects; inputs are resized to it
+                self._input_hw = (shape[2], shape[3])
+                self._input_host = torch.empty(
+                    shape, dtype=torch_dtype, pin_memory=True
+                )
+            else:
+                if len(shape) != 4 or shape[0] != 1:
+                    raise ValueError(
+                        f"Engine output binding has shape {shape}; expected"
+                        " (1, classes, height, width) probabilities"
+                    )
+                self._output_index = i
+                # Channel count the engine actually emits, mirroring the
+                # num_classes attribute of mmseg segmentors; the node sizes
+                # its remap table against this
+                self.num_classes = shape[1]
+                self._output_host = torch.empty(
+                    shape, dtype=torch_dtype, pin_memory=True
+                )
+        if self._input_index is None or self._output_index is None:
+            raise ValueError("Engine must have one input and one output binding")
+        self._bindings = [int(buf.data_ptr()) for buf in self._device_buffers]
+
+    def _run(self, img):
+        """
+        Preprocess one image and execute the engine asynchronously
+        \param img (numpy array float32, (h, w, 3)) input image, 0-255
+
+        On return the output device buffer holds the result; callers must
+        synchronize self.stream before reading it.
+        """
+        if img.shape[:2] != self._input_hw:
+            img = cv2.resize(
+                img,
+                (self._input_hw[1], self._input_hw[0]),
+                interpolation=cv2.INTER_LINEAR,
+            )
+        # Same channel handling and normalization as the mmseg Normalize step
+        if self._to_rgb:
+            img = img[..., ::-1]
+        img = (img - self._mean) / self._std
+        # (h, w, 3) -> (1, 3, h, w) into the pinned staging buffer
+        # (copy_ also handles the cast for fp16 engines)
+        chw = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)
+        self._input_host.copy_(chw[None])
+        with torch.cuda.stream(self.stream):
+            self._device_buffers[self._input_index].copy_(
+                self._input_host, non_blocking=True
+            )
+            self.context.execute_async_v2(
+                bindings=self._bindings, stream_handle=self.stream.cuda_stream
+            )
+
+    def __call__(self, img):
+        """
+        Run inference on one image
+        \param img (numpy array float32, (h, w, 3)) input image, 0-255
+        \return (numpy array float32, (h, w, c)) per-class probabilities
+        """
+        self._run(img)
+        with torch.cuda.stream(self.stream):
+            self._output_host.copy_(
+                self._device_buffers[self._output_index], non_blocking=True
+            )
+        self.stream.synchronize()
+        probs = self._output_host.float().numpy()[0]
+        return probs.transpose(1, 2, 0)
+
+    def infer_device(self, img):
+        """
+        Run inference and return the result still on the GPU
+        \param img (numpy array float32, (h, w, 3)) input image, 0-255
+        \return (torch tensor, (c, h', w')) per-class probabilities on the
+            engine's device, possibly fp16
+
+        No device-to-host copy is made; the tensor aliases the engine's
+        output buffer and is overwritten by the next call, so it must be
+        consumed before then.
+        """
+        self._run(img)
+        self.stream.synchronize()
+        return self._device_buffers[self._output_index][0]
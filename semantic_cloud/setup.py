@@ -3,7 +3,7 @@ from distutils.core import setup
 from catkin_pkg.python_setup import generate_distutils_setup
 # fetch values from package.xml
 setup_args = generate_distutils_setup(
-    packages=['color_pcl_generator', 'ptsemseg'],
+    packages=['color_pcl_generator', 'ptsemseg', 'trt_segmentor'],
     package_dir={'': 'include'},
 )
 setup(**setup_args)
@@ -12,24 +12,120 @@ from __future__ import division, print_function
 import json
 import os
 import sys
+import threading
 import time
+import traceback
+from collections import deque
 
 import cv2
 from cv2 import ROTATE_180
-import message_filters
 import numpy as np
 import ros_numpy
 import rospy
 from color_pcl_generator import ColorPclGenerator, PointType
 from cv_bridge import CvBridge, CvBridgeError
+import mmcv
 from mmseg.apis import inference_segmentor, init_segmentor
 from mmseg.core.evaluation import get_palette
+from trt_segmentor import TRTSegmentor
 from sensor_msgs.msg import Image, PointCloud2, CameraInfo
-from skimage.transform import resize
 import matplotlib.pyplot as plt
 
 import torch
 
+try:
+    from numba import njit, prange
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    from numba import cuda as numba_cuda
+
+    NUMBA_CUDA_AVAILABLE = numba_cuda.is_available()
+except ImportError:
+    NUMBA_CUDA_AVAILABLE = False
+
+if NUMBA_CUDA_AVAILABLE:
+
+    @numba_cuda.jit
+    def _fused_upsample_decode_kernel(low_label, remap_lut, cmap, out_bgr):
+        """
+        One thread per output pixel: compute the nearest-neighbour source
+        index, remap the class id through the LUT, look up the palette and
+        write bgr. Replaces the separate upsample, remap and decode passes
+        with a single pass over the output image.
+        """
+        i, j = numba_cuda.grid(2)
+        out_h = out_bgr.shape[0]
+        out_w = out_bgr.shape[1]
+        if i >= out_h or j >= out_w:
+            return
+        src_i = (i * low_label.shape[0]) // out_h
+        src_j = (j * low_label.shape[1]) // out_w
+        label = remap_lut[low_label[src_i, src_j]]
+        out_bgr[i, j, 0] = cmap[label, 2]
+        out_bgr[i, j, 1] = cmap[label, 1]
+        out_bgr[i, j, 2] = cmap[label, 0]
+
+if NUMBA_AVAILABLE:
+
+    @njit(parallel=True, cache=True)
+    def _remap_numba(input_classes, lut, out):
+        """Gather through the remap LUT row-parallel into a preallocated out"""
+        for i in prange(input_classes.shape[0]):
+            for j in range(input_classes.shape[1]):
+                out[i, j] = lut[input_classes[i, j]]
+
+    @njit(parallel=True, cache=True)
+    def _decode_numba(label, cmap, out):
+        """Palette lookup (rgb cmap -> bgr out) row-parallel, no temporaries"""
+        for i in prange(label.shape[0]):
+            for j in range(label.shape[1]):
+                l = label[i, j]
+                out[i, j, 0] = cmap[l, 2]
+                out[i, j, 1] = cmap[l, 1]
+                out[i, j, 2] = cmap[l, 0]
+
+
+def _find_img_scale(pipeline):
+    """
+    Find the test-time img_scale in an mmseg test pipeline
+    \param pipeline (list of dict) pipeline steps, possibly nested inside
+        wrappers such as MultiScaleFlipAug
+    \return (tuple) the img_scale, or None if the pipeline has none
+    """
+    for step in pipeline:
+        if step.get("img_scale") is not None:
+            scale = step["img_scale"]
+            if isinstance(scale, list):
+                # Multi-scale testing; run single-scale at the first entry
+                scale = scale[0]
+            return tuple(scale)
+        if "transforms" in step:
+            found = _find_img_scale(step["transforms"])
+            if found is not None:
+                return found
+    return None
+
+
+def build_remap_lut(remap: np.array, n_classes: int, background_value: int = 7):
+    """Build a lookup table mapping predicted class ids to remapped ids
+
+    Classes without a remap entry are sent to the background class.
+    \param remap (numpy array) the ith entry is the output id for input class i
+    \param n_classes (int) number of classes the network can predict
+    \param background_value (int) output id for classes not covered by remap
+    \return (numpy array) lookup table indexable by raw class id
+    """
+    remap = np.asarray(remap)
+    lut = np.full(
+        max(len(remap), n_classes), background_value, dtype=remap.dtype
+    )
+    lut[: len(remap)] = remap
+    return lut
+
 
 def remap_classes_bool_indexing(
     input_classes: np.array, remap: np.array, background_value: int = 7
@@ -37,12 +133,69 @@ def remap_classes_bool_indexing(
     """Change indices based on input
 
     https://stackoverflow.com/questions/3403973/fast-replacement-of-values-in-a-numpy-array
+    The boolean-mask loop was replaced by a single LUT gather, which makes
+    one pass over the label image instead of one per remap entry. When numba
+    is available the gather runs as a parallel JIT kernel.
     """
-    output = np.ones_like(input_classes) * background_value
-    for i, v in enumerate(remap):
-        mask = input_classes == i
-        output[mask] = v
-    return output
+    lut = build_remap_lut(
+        remap, int(input_classes.max()) + 1, background_value=background_value
+    )
+    if NUMBA_AVAILABLE and input_classes.ndim == 2:
+        output = np.empty_like(input_classes)
+        _remap_numba(input_classes, lut, output)
+        return output
+    return lut[input_classes]
+
+
+def lidar_xyz_view(lidar):
+    """
+    Get the xyz fields of a structured point cloud as an (n, 3) float32 array
+    \param lidar (structured numpy array) from ros_numpy.numpify(PointCloud2)
+    \return (n, 3) float32 array, a zero-copy view when possible
+
+    For the usual PointCloud2 layout (x, y, z adjacent float32 fields at
+    offsets 0/4/8, itemsize a multiple of 4) the fields can be viewed
+    directly without copying; otherwise fall back to stacking them.
+    """
+    dtype = lidar.dtype
+    names = dtype.names
+    if (
+        names is not None
+        and len(names) >= 3
+        and names[:3] == ("x", "y", "z")
+        and all(dtype.fields[n][0] == np.float32 for n in names[:3])
+        and tuple(dtype.fields[n][1] for n in names[:3]) == (0, 4, 8)
+        and dtype.itemsize % 4 == 0
+    ):
+        return lidar.view((np.float32, dtype.itemsize // 4))[:, :3]
+    return np.stack((lidar["x"], lidar["y"], lidar["z"]), axis=1)
+
+
+def image_msg_from_array(array, encoding="bgr8", msg=None):
+    """
+    Fill a sensor_msgs Image directly from a numpy array
+    \param array (numpy array uint8, (h, w, c)) the image to publish
+    \param encoding (str) ros image encoding
+    \param msg (sensor_msgs.Image) message to reuse, a new one if None
+    \return (sensor_msgs.Image) the filled message
+
+    Cheaper than ros_numpy.msgify: the metadata fields are set in place on
+    a reused message and the payload is a single tobytes() of the
+    contiguous array. genpy's generated serializer packs uint8[] data with
+    struct's 's' format, which only accepts bytes, so the payload cannot be
+    handed over as a memoryview.
+    """
+    if msg is None:
+        msg = Image()
+    if not array.flags["C_CONTIGUOUS"]:
+        array = np.ascontiguousarray(array)
+    msg.height = array.shape[0]
+    msg.width = array.shape[1]
+    msg.encoding = encoding
+    msg.is_bigendian = False
+    msg.step = array.strides[0]
+    msg.data = array.tobytes()
+    return msg
 
 
 def color_map(N=256, normalized=False):
@@ -53,44 +206,39 @@ def color_map(N=256, normalized=False):
     \return (Nx3 numpy array) a color map
     """
 
-    def bitget(byteval, idx):
-        return (byteval & (1 << idx)) != 0
-
-    dtype = "float32" if normalized else "uint8"
-    cmap = np.zeros((N, 3), dtype=dtype)
-    for i in range(N):
-        r = g = b = 0
-        c = i
-        for j in range(8):
-            r = r | (bitget(c, 0) << 7 - j)
-            g = g | (bitget(c, 1) << 7 - j)
-            b = b | (bitget(c, 2) << 7 - j)
-            c = c >> 3
-        cmap[i] = np.array([r, g, b])
-    cmap = cmap / 255.0 if normalized else cmap
+    ids = np.arange(N, dtype=np.uint32)
+    cmap = np.zeros((N, 3), dtype=np.uint8)
+    # Same bit trick as the VOC reference implementation, but each output
+    # bit is one vectorized op over all N entries instead of a Python loop
+    for j in range(8):
+        cmap[:, 0] |= (((ids >> (3 * j)) & 1) << (7 - j)).astype(np.uint8)
+        cmap[:, 1] |= (((ids >> (3 * j + 1)) & 1) << (7 - j)).astype(np.uint8)
+        cmap[:, 2] |= (((ids >> (3 * j + 2)) & 1) << (7 - j)).astype(np.uint8)
+    if normalized:
+        return cmap.astype(np.float32) / 255.0
     return cmap
 
 
-def decode_segmap(temp, n_classes, cmap):
+def decode_segmap(temp, n_classes, cmap, out=None):
     """
     Given an image of class predictions, produce an bgr8 image with class colors
     \param temp (2d numpy int array) input image with semantic classes (as integer)
     \param n_classes (int) number of classes
     \cmap (Nx3 numpy array) input color map
+    \param out (numpy array uint8, (h, w, 3)) optional destination buffer
     \return (numpy array bgr8) the decoded image with class colors
     """
-    r = temp.copy()
-    g = temp.copy()
-    b = temp.copy()
-    for l in range(0, n_classes):
-        r[temp == l] = cmap[l, 0]
-        g[temp == l] = cmap[l, 1]
-        b[temp == l] = cmap[l, 2]
-    bgr = np.zeros((temp.shape[0], temp.shape[1], 3))
-    bgr[:, :, 0] = b
-    bgr[:, :, 1] = g
-    bgr[:, :, 2] = r
-    return bgr.astype(np.uint8)
+    # Guard against labels outside the color map before the gather
+    temp = np.minimum(temp, n_classes - 1)
+    if out is None:
+        out = np.empty((temp.shape[0], temp.shape[1], 3), dtype=np.uint8)
+    if NUMBA_AVAILABLE and temp.ndim == 2:
+        _decode_numba(temp, cmap, out)
+        return out
+    # A single fancy-indexed lookup replaces the per-class boolean passes,
+    # reversing the channel order to get bgr
+    out[...] = cmap[temp][..., ::-1]
+    return out
 
 
 class SemanticCloud:
@@ -138,6 +286,16 @@ class SemanticCloud:
         if not np.allclose((det := np.linalg.det(self.extrinsics[:3, :3])), 1):
             raise ValueError(f"Extrinsics do not contain a valid rotation, det = {det}")
 
+        # The camera is mounted upside down. Instead of rotating every image
+        # 180 degrees before the CNN (and un-rotating the output), bake the
+        # rotation into the extrinsics so the lidar projection lands in the
+        # original image coordinates and the pixels are never touched. The
+        # principal point must be mirrored to match (see _mirror_intrinsics);
+        # together the two reproduce the old rotated sampling exactly.
+        self.rotate_180 = rospy.get_param("/camera/rotate_180", True)
+        if self.rotate_180:
+            self.extrinsics = np.diag([-1.0, -1.0, 1.0, 1.0]) @ self.extrinsics
+
         self.n_classes = rospy.get_param("/semantic_pcl/num_classes")
         self.cmap = color_map(N=self.n_classes, normalized=False)
         # Color map for semantic classes
@@ -160,18 +318,123 @@ class SemanticCloud:
             device = rospy.get_param("/device")
             self.remap = np.asarray(rospy.get_param("/semantic_pcl/class_remap"))
             self.num_classes = np.asarray(rospy.get_param("/semantic_pcl/num_classes"))
-            print("Setting up CNN model...")
-            self.model = init_segmentor(config_path, model_path, device=device,)
+            # Optionally quantize probabilities to uint8 before the CPU
+            # argmax/top-k reductions read them, quartering the bytes moved
+            self._quantize_probs = rospy.get_param(
+                "/semantic_pcl/quantize_probabilities", False
+            )
+            self._probs_u8 = None  # Sized lazily from the CNN output
+            if NUMBA_AVAILABLE:
+                # Warm the JIT kernels so the first real frame doesn't pay
+                # the compilation cost
+                dummy = np.zeros((2, 2), dtype=np.int32)
+                decode_segmap(dummy, self.n_classes, self.cmap)
+                remap_classes_bool_indexing(dummy, self.remap)
+            # Optional TensorRT engine exported from the mmseg model. When
+            # set, it replaces the FP32 PyTorch forward pass entirely.
+            trt_engine_path = rospy.get_param("/semantic_pcl/trt_engine_path", "")
+            self._use_trt = bool(trt_engine_path)
+            if self._use_trt:
+                print("Setting up TensorRT engine...")
+                self.model = TRTSegmentor(trt_engine_path, config_path, device=device)
+            else:
+                print("Setting up CNN model...")
+                self.model = init_segmentor(config_path, model_path, device=device,)
             # End my version
 
+            # Precompute the remap lookup table once so the per-frame remap
+            # is a single gather. It is sized by the channel count the model
+            # actually emits (unknown before the model is built), not the
+            # remapped class count: a raw argmax id past the end of the remap
+            # table must land on the background entry rather than index past
+            # the end of the LUT.
+            self._remap_lut = build_remap_lut(
+                self.remap, int(self.model.num_classes)
+            )
+
+            # Preallocate the preprocessing buffers once; every frame is
+            # written into these instead of allocating fresh arrays
+            self._resized_u8 = np.empty((*self.cnn_input_size, 3), dtype=np.uint8)
+            self._rgb_u8 = np.empty_like(self._resized_u8)
+            self._rot_u8 = np.empty_like(self._resized_u8)
+            self._in_f32 = np.empty(self._resized_u8.shape, dtype=np.float32)
+            # Destination buffers for the full-resolution outputs so the
+            # resize and decode stages write in place instead of allocating
+            self._label_resized = np.empty(
+                (self.img_height, self.img_width), dtype=np.int32
+            )
+            self._semantic_color = np.empty(
+                (self.img_height, self.img_width, 3), dtype=np.uint8
+            )
+            self._conf_resized = np.empty(
+                (self.img_height, self.img_width), dtype=np.float32
+            )
+
+            self.device = device
+            self._use_cuda = "cuda" in str(device) and torch.cuda.is_available()
+            if self._use_cuda:
+                # Upload the lookup tables once so per-frame postprocessing
+                # on the GPU is pure gathers with a single uint8 copy back
+                self._remap_lut_torch = torch.from_numpy(
+                    self._remap_lut.astype(np.int64)
+                ).to(device)
+                # Stored already channel-reversed so the per-frame lookup is
+                # a single contiguous gather with no bgr reordering
+                self._cmap_torch_bgr = torch.from_numpy(
+                    np.ascontiguousarray(self.cmap[:, ::-1])
+                ).to(device)
+                # Dedicated stream plus pinned staging buffers so H2D/D2H
+                # copies run async and GPU work can overlap the CPU side of
+                # the next frame
+                self._stream = torch.cuda.Stream(device=device)
+                self._color_out_pinned = torch.empty(
+                    (self.img_height, self.img_width, 3),
+                    dtype=torch.uint8,
+                    pin_memory=True,
+                )
+                self._conf_out_pinned = torch.empty(
+                    (self.img_height, self.img_width),
+                    dtype=torch.float32,
+                    pin_memory=True,
+                )
+                # Normalization constants and the test-pipeline input size
+                # for the on-device forward pass, pulled lazily from the
+                # model config
+                self._norm_mean_torch = None
+                self._norm_std_torch = None
+                self._test_in_f32 = None
+                self._use_numba_cuda = NUMBA_CUDA_AVAILABLE
+                if self._use_numba_cuda:
+                    # Run the fused kernel on the same stream as the torch
+                    # work, with its lookup tables resident on-device
+                    self._numba_stream = numba_cuda.external_stream(
+                        self._stream.cuda_stream
+                    )
+                    self._remap_lut_cuda = numba_cuda.to_device(
+                        self._remap_lut.astype(np.int32)
+                    )
+                    self._cmap_cuda = numba_cuda.to_device(self.cmap)
+                    self._bgr_dev = torch.empty(
+                        (self.img_height, self.img_width, 3),
+                        dtype=torch.uint8,
+                        device=device,
+                    )
+
         # Declare array containers
         if self.point_type is PointType.SEMANTICS_BAYESIAN:
             self.semantic_colors = np.zeros(
                 (3, self.img_height, self.img_width, 3), dtype=np.uint8
             )  # Numpy array to store 3 decoded semantic images with highest confidences
-            self.confidences = np.zeros(
-                (3, self.img_height, self.img_width), dtype=np.float32
-            )  # Numpy array to store top 3 class confidences
+            self._labels_resized = np.empty(
+                (3, self.img_height, self.img_width), dtype=np.int32
+            )  # Scratch for the upsampled top-3 label maps
+            # Low-resolution colors/confidences on the CNN output grid; the
+            # cloud generator samples these per lidar point so the full
+            # resolution versions are only decoded for visualization
+            self._semantic_colors_lowres = None
+            self._confidences_lowres = None
+            self._lowres_scale = None
+            self._sem_color0_fresh = False
         # Set up ROS
         print("Setting up ROS...")
         self.bridge = (
@@ -181,6 +444,8 @@ class SemanticCloud:
         self.sem_img_pub = rospy.Publisher(
             "/semantic_pcl/semantic_image", Image, queue_size=1
         )
+        # Reused message; only its data view is swapped each publish
+        self._sem_img_msg = Image()
         # Set up ros image subscriber
         # Set buff_size to average msg size to avoid accumulating delay
         if gen_pcl:
@@ -196,18 +461,37 @@ class SemanticCloud:
             intrinsic = np.matrix(
                 [[fx, 0, cx], [0, fy, cy], [0, 0, 1]], dtype=np.float32
             )
+            intrinsic = self._mirror_intrinsics(intrinsic)
             self.pcl_pub = rospy.Publisher(
                 "/semantic_pcl/semantic_pcl", PointCloud2, queue_size=1
             )
-            self.color_sub = message_filters.Subscriber(
+            # Ring buffers, one per topic. The subscriber callbacks only
+            # append the raw message; pairing by timestamp and the expensive
+            # numpify/inference run on a single consumer thread so the ROS
+            # threads never back up behind the CNN.
+            self._color_ring = deque(maxlen=8)
+            self._lidar_ring = deque(maxlen=8)
+            self._pair_ready = threading.Event()
+            self._sync_slop = 0.3  # Max time gap between paired stamps (s)
+            # Frames older than this by the time they reach the pipeline are
+            # dropped rather than fed to the CNN
+            self._max_lag = rospy.Duration(
+                rospy.get_param("/semantic_pcl/max_frame_lag", 0.5)
+            )
+            # Stamp of the last frame fully processed; older frames that
+            # were queued behind it are skipped rather than fed to the CNN
+            self._last_done_stamp = rospy.Time(0)
+            self.color_sub = rospy.Subscriber(
                 rospy.get_param("/semantic_pcl/color_image_topic"),
                 Image,
+                self._color_ring_callback,
                 queue_size=1,
                 buff_size=30 * 480 * 640,
             )
-            self.lidar_sub = message_filters.Subscriber(
+            self.lidar_sub = rospy.Subscriber(
                 rospy.get_param("/semantic_pcl/lidar_topic"),
                 PointCloud2,
+                self._lidar_ring_callback,
                 queue_size=1,
                 # buff_size=40 * 480 * 640, # TODO set the buff size
             )  # increase buffer size to avoid delay (despite queue_size = 1)
@@ -217,11 +501,9 @@ class SemanticCloud:
             self.intrinsics_sub = rospy.Subscriber(
                 intrinsic_topic, CameraInfo, self.intrinsics_calback, queue_size=1,
             )  # increase buffer size to avoid delay (despite queue_size = 1)
-            self.ts = message_filters.ApproximateTimeSynchronizer(
-                [self.color_sub, self.lidar_sub], queue_size=1, slop=0.3
-            )  # Take in one color image and one depth image with a limite time gap between message time stamps
             # TODO assume figure out if we can ever expect to deal with changing intrinsics
-            self.ts.registerCallback(self.color_lidar_callback)
+            self._sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+            self._sync_thread.start()
             include_background = rospy.get_param("/semantic_pcl/include_background")
 
             # TODO Consider if something alterative to this needs to be added
@@ -253,10 +535,105 @@ class SemanticCloud:
         )
         self.pub_vis = rospy.Publisher("/seg_vis", Image, queue_size=1)
 
+    def _color_ring_callback(self, color_img_ros):
+        """
+        Store the raw color image message and wake the consumer thread
+        \param color_img_ros (sensor_msgs.Image)
+        """
+        self._color_ring.append(color_img_ros)
+        self._pair_ready.set()
+
+    def _lidar_ring_callback(self, lidar_ros):
+        """
+        Store the raw lidar message and wake the consumer thread
+        \param lidar_ros (sensor_msgs.PointCloud2)
+        """
+        self._lidar_ring.append(lidar_ros)
+        self._pair_ready.set()
+
+    def _pop_synced_pair(self):
+        """
+        Pair the newest color image with the nearest-stamped lidar scan
+        \return (Image, PointCloud2) pair, or None if no pair is ready
+
+        The image is not committed until a scan stamped at or after it has
+        been buffered (or the image has aged past the slop, at which point
+        the match cannot improve). Lidar sweeps are typically published
+        slightly behind the image with the matching stamp; consuming the
+        image immediately would pair it with the previous sweep or drop it.
+        """
+        if not self._color_ring or not self._lidar_ring:
+            return None
+        color_img_ros = self._color_ring[-1]
+        img_stamp = color_img_ros.header.stamp
+        if (
+            self._lidar_ring[-1].header.stamp < img_stamp
+            and (rospy.Time.now() - img_stamp).to_sec() < self._sync_slop
+        ):
+            # The matching scan may still be in flight; wait for it
+            return None
+        # Commit to this image; anything older in the ring is stale
+        self._color_ring.clear()
+
+        best = None
+        while self._lidar_ring:
+            lidar_ros = self._lidar_ring.popleft()
+            if best is None or abs((lidar_ros.header.stamp - img_stamp).to_sec()) <= abs(
+                (best.header.stamp - img_stamp).to_sec()
+            ):
+                best = lidar_ros
+            else:
+                # Stamps are monotonic, so this scan is further away than the
+                # last; keep it buffered for the next image
+                self._lidar_ring.appendleft(lidar_ros)
+                break
+        if best is None or abs((best.header.stamp - img_stamp).to_sec()) > self._sync_slop:
+            return None
+        return (color_img_ros, best)
+
+    def _sync_loop(self):
+        """
+        Consumer thread: pair buffered messages by timestamp and run the
+        full semantic cloud pipeline on each pair
+        """
+        while not rospy.is_shutdown():
+            # Re-check on timeout too: a deferred image may hit its slop
+            # deadline without any new message arriving to set the event
+            self._pair_ready.wait(timeout=0.1)
+            self._pair_ready.clear()
+            pair = self._pop_synced_pair()
+            if pair is not None:
+                # Contain per-frame failures; an uncaught exception would
+                # permanently kill the only processing thread
+                try:
+                    self.color_lidar_callback(*pair)
+                except Exception:
+                    rospy.logerr(
+                        "Semantic cloud pipeline failed on a frame:\n%s",
+                        traceback.format_exc(),
+                    )
+
+    def _mirror_intrinsics(self, K):
+        """
+        Mirror the principal point to account for the 180 degree rotation
+        \param K ((3, 3) matrix) camera intrinsics for the un-rotated image
+        \return ((3, 3) matrix) intrinsics matching the rotated extrinsics
+
+        A 180 degree image rotation maps pixel (u, v) to (W-1-u, H-1-v).
+        Rotating the camera frame in the extrinsics flips the sign of the
+        focal terms; mirroring the principal point completes the identity
+        so no assumption about where the principal point sits is needed.
+        """
+        if self.rotate_180:
+            K = K.copy()
+            K[0, 2] = (self.img_width - 1) - K[0, 2]
+            K[1, 2] = (self.img_height - 1) - K[1, 2]
+        return K
+
     def intrinsics_calback(self, intrinsics):
         K = np.array(intrinsics.K)
         K = np.array(K.reshape((3, 3)))
-        self.cloud_generator.set_intrinsics(K)
+        self.cloud_generator.set_intrinsics(self._mirror_intrinsics(K))
         # TODO create a remapper that respects the distortion model
 
     def color_callback(self, color_img_ros):
@@ -275,25 +652,20 @@ class SemanticCloud:
         class_probs = self.predict(color_img)
         confidence, label = class_probs.max(1)
         confidence, label = confidence.squeeze(0).numpy(), label.squeeze(0).numpy()
-        label = resize(
-            label,
-            (self.img_height, self.img_width),
-            order=0,
-            mode="reflect",
-            anti_aliasing=False,
-            preserve_range=True,
-        )  # order = 0, nearest neighbour
-        label = label.astype(int)
+        # cv2.resize takes (width, height) and stays in the source dtype
+        label = cv2.resize(
+            label.astype(np.int32),
+            (self.img_width, self.img_height),
+            interpolation=cv2.INTER_NEAREST,
+        )
         # Add semantic class colors
         decoded = decode_segmap(
             label, self.n_classes, self.cmap
         )  # Show input image and decoded image
-        confidence = resize(
+        confidence = cv2.resize(
             confidence,
-            (self.img_height, self.img_width),
-            mode="reflect",
-            anti_aliasing=True,
-            preserve_range=True,
+            (self.img_width, self.img_height),
+            interpolation=cv2.INTER_LINEAR,
         )
 
         cv2.imshow("Camera image", color_img)
@@ -302,10 +674,40 @@ class SemanticCloud:
         cv2.waitKey(3)
 
     def color_lidar_callback(self, color_img_ros, lidar_ros):
+        """
+        Guarded entry point for the semantic cloud pipeline. Frames that are
+        already stale, or older than the last frame fully processed, are
+        dropped (a fresher one will follow) so no backlog builds up ahead of
+        the CNN.
+        \param color_img_ros (sensor_msgs.Image) the input color image (bgr8)
+        \param lidar_ros (sensor_msgs.PointCloud2) the lidar in its own frame
+        """
+        img_stamp = color_img_ros.header.stamp
+        lag = rospy.Time.now() - img_stamp
+        if lag > self._max_lag:
+            # Throttled so sustained overload (inference slower than
+            # max_frame_lag makes every frame stale at pickup and nothing
+            # is ever published) is diagnosable in the field
+            rospy.logwarn_throttle(
+                5.0,
+                "Dropping stale frame: %.2fs old, max_frame_lag is %.2fs",
+                lag.to_sec(),
+                self._max_lag.to_sec(),
+            )
+            return
+        if img_stamp <= self._last_done_stamp:
+            rospy.logwarn_throttle(
+                5.0, "Dropping frame not newer than the last completed one"
+            )
+            return
+        self._process_color_lidar(color_img_ros, lidar_ros)
+        self._last_done_stamp = img_stamp
+
+    def _process_color_lidar(self, color_img_ros, lidar_ros):
         """
         Callback function to produce point cloud registered with semantic class color based on input color image and depth image
         \param color_img_ros (sensor_msgs.Image) the input color image (bgr8)
-        \param lidar_ros (sensor_msgs.PointCloud2) the lidar in its own frame. TODO 
+        \param lidar_ros (sensor_msgs.PointCloud2) the lidar in its own frame. TODO
         """
         # Convert ros Image message to numpy array
         try:
@@ -316,11 +718,17 @@ class SemanticCloud:
         except CvBridgeError as e:
             print(e)
 
-        lidar_points = np.stack((lidar["x"], lidar["y"], lidar["z"]), axis=1)
+        lidar_points = lidar_xyz_view(lidar)
 
         if self.point_type is PointType.COLOR:
             cloud_ros = self.cloud_generator.generate_cloud_color(
-                color_img, lidar_points, color_img_ros.header.stamp,
+                color_img,
+                lidar_points,
+                color_img_ros.header.stamp,
+                # Same projection as the semantic paths; the mirrored
+                # intrinsics are only exact paired with the rotated
+                # extrinsics
+                extrinsics=self.extrinsics,
             )
         else:
             # Do semantic segmantation
@@ -336,33 +744,43 @@ class SemanticCloud:
                     color_img_ros.header.stamp,  # Used to be rospy.Time.now(), I'm not sure which is better
                     is_lidar=True,
                     extrinsics=self.extrinsics,
+                    # The 180 degree rotation is baked into the extrinsics
+                    rotate_img_180=False,
                 )
 
             elif self.point_type is PointType.SEMANTICS_BAYESIAN:
                 self.predict_bayesian(color_img)
                 # Produce point cloud with rgb colors, semantic colors and confidences
-                # TODO see if this should really be rotating
+                # The generator samples the low-resolution grids per point
                 cloud_ros = self.cloud_generator.generate_cloud_semantic_bayesian(
                     color_img,
                     lidar_points,
-                    self.semantic_colors,
-                    self.confidences,
+                    self._semantic_colors_lowres,
+                    self._confidences_lowres,
                     color_img_ros.header.stamp,
                     is_lidar=True,
                     extrinsics=self.extrinsics,
+                    # The 180 degree rotation is baked into the extrinsics
+                    rotate_img_180=False,
+                    color_scale=self._lowres_scale,
                 )
 
             # Publish semantic image
             if self.sem_img_pub.get_num_connections() > 0:
                 if self.point_type is PointType.SEMANTICS_MAX:
-                    semantic_color_msg = ros_numpy.msgify(
-                        Image, semantic_color, encoding="bgr8"
+                    semantic_color_msg = image_msg_from_array(
+                        semantic_color, encoding="bgr8", msg=self._sem_img_msg
                     )
-                else:
-                    semantic_color_msg = ros_numpy.msgify(
-                        Image, self.semantic_colors[0], encoding="bgr8"
+                elif self._sem_color0_fresh:
+                    semantic_color_msg = image_msg_from_array(
+                        self.semantic_colors[0], encoding="bgr8", msg=self._sem_img_msg
                     )
-                self.sem_img_pub.publish(semantic_color_msg)
+                else:
+                    # A subscriber appeared after this frame was predicted;
+                    # the decoded image will be available next frame
+                    semantic_color_msg = None
+                if semantic_color_msg is not None:
+                    self.sem_img_pub.publish(semantic_color_msg)
 
         # Publish point cloud
         self.pcl_pub.publish(cloud_ros)
@@ -372,105 +790,302 @@ class SemanticCloud:
         Do semantic prediction for max fusion
         \param img (numpy array rgb8)
         """
+        if self._use_cuda:
+            return self._predict_max_gpu(img)
         class_probs = self.predict(img)
+        if self._quantize_probs:
+            class_probs = self._quantize_probs_to_u8(class_probs)
         # Take best prediction and confidence
         # TODO Check this matches the previous behavior
         # class_probs.max(1)
         pred_confidence = np.max(class_probs, axis=2)
         pred_label = np.argmax(class_probs, axis=2)
+        if self._quantize_probs:
+            # Dequantize only the selected per-pixel confidence
+            pred_confidence = pred_confidence.astype(np.float32) / 255.0
 
         if self.remap is not None:
-            pred_label = remap_classes_bool_indexing(pred_label, self.remap)
+            pred_label = self._remap_lut[pred_label]
 
         # pred_confidence = pred_confidence.squeeze(0).cpu().numpy()
         # pred_label = pred_label.squeeze(0).cpu().numpy()
-        pred_label = resize(
-            pred_label,
-            (self.img_height, self.img_width),
-            order=0,
-            mode="reflect",
-            anti_aliasing=False,
-            preserve_range=True,
-        )  # order = 0, nearest neighbour
-        pred_label = pred_label.astype(int)
+        # Nearest-neighbour upsample of the label map, staying in int32
+        pred_label = cv2.resize(
+            pred_label.astype(np.int32),
+            (self.img_width, self.img_height),
+            dst=self._label_resized,
+            interpolation=cv2.INTER_NEAREST,
+        )
         # Add semantic color
-        semantic_color = decode_segmap(pred_label, self.n_classes, self.cmap)
-        pred_confidence = resize(
+        semantic_color = decode_segmap(
+            pred_label, self.n_classes, self.cmap, out=self._semantic_color
+        )
+        pred_confidence = cv2.resize(
             pred_confidence,
-            (self.img_height, self.img_width),
-            mode="reflect",
-            anti_aliasing=True,
-            preserve_range=True,
+            (self.img_width, self.img_height),
+            dst=self._conf_resized,
+            interpolation=cv2.INTER_LINEAR,
         )
         return (semantic_color, pred_confidence)
 
+    def _quantize_probs_to_u8(self, class_probs):
+        """
+        Quantize class probabilities to uint8 in a cached buffer
+        \param class_probs (numpy array float32, (h, w, c)) probabilities 0-1
+        \return (numpy array uint8) probabilities scaled to 0-255
+
+        The argmax/top-k reductions only need the ordering, so they can read
+        8-bit values (a quarter of the memory traffic); the few confidences
+        that are actually kept get dequantized afterwards.
+        """
+        if self._probs_u8 is None or self._probs_u8.shape != class_probs.shape:
+            self._probs_u8 = np.empty(class_probs.shape, dtype=np.uint8)
+        np.multiply(class_probs, 255.0, out=self._probs_u8, casting="unsafe")
+        return self._probs_u8
+
+    def _mmseg_probs_device(self, img):
+        """
+        Forward pass returning per-class probabilities still on the GPU
+        \param img (numpy array float32 rgb, (h, w, 3)) preprocessed image
+        \return (torch tensor float32, (c, h', w')) on self.device
+
+        Bypasses inference_segmentor, which converts its result to numpy on
+        the host, but replicates what its test pipeline would have done to
+        the image: the keep-ratio resize onto the config's img_scale and
+        the Normalize step including its channel swap, so this path
+        predicts the same as the CPU and TensorRT backends. Only the
+        rescaled input crosses to the device and the probability tensor
+        never leaves it.
+        """
+        if self._norm_mean_torch is None:
+            norm = self.model.cfg.img_norm_cfg
+            self._norm_mean_torch = torch.tensor(
+                norm["mean"], device=self.device
+            ).view(3, 1, 1)
+            self._norm_std_torch = torch.tensor(
+                norm["std"], device=self.device
+            ).view(3, 1, 1)
+            # Normalize(to_rgb=True) swaps the channels of whatever it is
+            # fed; _preprocess already produced rgb, so mirror the swap to
+            # feed the network the same order as the other backends
+            self._norm_flip = bool(norm.get("to_rgb", True))
+            # Run the network at the size the pipeline's Resize step would
+            # pick, not camera resolution; this is what the baseline did
+            # and it is several times cheaper
+            img_scale = _find_img_scale(self.model.cfg.data.test.pipeline)
+            if img_scale is not None:
+                new_w, new_h = mmcv.rescale_size(
+                    (img.shape[1], img.shape[0]), img_scale
+                )
+                self._test_hw = (new_h, new_w)
+            else:
+                self._test_hw = (img.shape[0], img.shape[1])
+        if img.shape[:2] != self._test_hw:
+            if self._test_in_f32 is None:
+                self._test_in_f32 = np.empty(
+                    (*self._test_hw, 3), dtype=np.float32
+                )
+            img = cv2.resize(
+                img,
+                (self._test_hw[1], self._test_hw[0]),
+                dst=self._test_in_f32,
+                interpolation=cv2.INTER_LINEAR,
+            )
+        tensor = torch.from_numpy(img).to(self.device, non_blocking=True)
+        tensor = tensor.permute(2, 0, 1)
+        if self._norm_flip:
+            tensor = tensor.flip(0)
+        tensor = (tensor - self._norm_mean_torch) / self._norm_std_torch
+        shape = img.shape
+        img_meta = [
+            {
+                "ori_shape": shape,
+                "img_shape": shape,
+                "pad_shape": shape,
+                "scale_factor": 1.0,
+                "flip": False,
+            }
+        ]
+        with torch.no_grad():
+            logits = self.model.whole_inference(
+                tensor[None], img_meta, rescale=False
+            )
+        return torch.nn.functional.softmax(logits, dim=1)[0]
+
+    def _predict_max_gpu(self, img):
+        """
+        Fused max/remap/upsample/decode on the GPU for max fusion
+        \param img (numpy array rgb8)
+
+        The class probabilities are produced and consumed on-device, so the
+        only transfers are the small input image up and the final uint8
+        color image plus float32 confidence back down; the full per-class
+        tensor never crosses the bus.
+        """
+        img = self._preprocess(img)
+        with torch.cuda.stream(self._stream):
+            if self._use_trt:
+                # Aliases the engine's output buffer; consumed before the
+                # next call overwrites it
+                probs = self.model.infer_device(img)
+            else:
+                probs = self._mmseg_probs_device(img)
+            # float() is a no-op for fp32 and lifts fp16 TRT outputs
+            pred_confidence, pred_label = probs.float().max(dim=0)
+            if self._use_numba_cuda:
+                # Remap, nearest upsample and palette lookup fused into one
+                # kernel launch writing the bgr image directly
+                threads = (16, 16)
+                blocks = (
+                    (self.img_height + threads[0] - 1) // threads[0],
+                    (self.img_width + threads[1] - 1) // threads[1],
+                )
+                _fused_upsample_decode_kernel[blocks, threads, self._numba_stream](
+                    numba_cuda.as_cuda_array(pred_label.to(torch.int32)),
+                    self._remap_lut_cuda,
+                    self._cmap_cuda,
+                    numba_cuda.as_cuda_array(self._bgr_dev),
+                )
+                semantic_color = self._bgr_dev
+            else:
+                if self.remap is not None:
+                    pred_label = self._remap_lut_torch[pred_label]
+                # interpolate wants a (batch, channel, h, w) float input
+                pred_label = torch.nn.functional.interpolate(
+                    pred_label[None, None].float(),
+                    size=(self.img_height, self.img_width),
+                    mode="nearest",
+                )[0, 0].long()
+                # Palette lookup straight from the bgr-ordered table; one
+                # coalesced load per pixel
+                semantic_color = torch.index_select(
+                    self._cmap_torch_bgr, 0, pred_label.reshape(-1)
+                ).reshape(self.img_height, self.img_width, 3)
+            pred_confidence = torch.nn.functional.interpolate(
+                pred_confidence[None, None],
+                size=(self.img_height, self.img_width),
+                mode="bilinear",
+                align_corners=False,
+            )[0, 0]
+            self._color_out_pinned.copy_(semantic_color, non_blocking=True)
+            self._conf_out_pinned.copy_(pred_confidence, non_blocking=True)
+        # Only block once the CPU actually needs the results
+        self._stream.synchronize()
+        return (self._color_out_pinned.numpy(), self._conf_out_pinned.numpy())
+
     def predict_bayesian(self, img):
         """
         Do semantic prediction for bayesian fusion
         \param img (numpy array rgb8)
+
+        The results are kept on the low-resolution CNN output grid; the
+        cloud generator samples them per projected lidar point, so the only
+        full-resolution work is decoding the top-confidence image, and that
+        only happens while the semantic image topic has a subscriber.
         """
         class_probs = self.predict(img)
-        # Take 3 best predictions and their confidences (probabilities)
-        # TODO see if I can avoid casting to a tensor
-        # The copy is to avoid a negative stride error
-        pred_confidences, pred_labels = torch.topk(
-            input=torch.Tensor(class_probs.copy()),
-            k=3,
-            dim=2,
-            largest=True,
-            sorted=True,
+        if self._quantize_probs:
+            class_probs = self._quantize_probs_to_u8(class_probs)
+        # Take 3 best predictions and their confidences (probabilities).
+        # argpartition selects the top 3 in a single pass without the copy
+        # and torch round-trip that topk needed
+        pred_labels = np.argpartition(class_probs, -3, axis=2)[..., -3:]
+        pred_confidences = np.take_along_axis(class_probs, pred_labels, axis=2)
+        if self._quantize_probs:
+            # Dequantize just the 3 selected entries per pixel (also needed
+            # before negating for the sort below)
+            pred_confidences = pred_confidences.astype(np.float32) / 255.0
+        # Only the 3 selected entries still need ordering (descending)
+        order = np.argsort(-pred_confidences, axis=2)
+        pred_labels = np.take_along_axis(pred_labels, order, axis=2)
+        pred_confidences = np.take_along_axis(pred_confidences, order, axis=2)
+        # (h', w', 3) -> (3, h', w') with the class rank leading, matching
+        # the layout the cloud generator samples
+        labels = np.minimum(
+            pred_labels.transpose(2, 0, 1), self.n_classes - 1
+        ).astype(np.int32)
+        # Decode all 3 low-resolution label maps with one gather; this is
+        # ~(W*H)/(w'*h') cheaper than decoding at full resolution
+        self._semantic_colors_lowres = self.cmap[labels][..., ::-1]
+        self._confidences_lowres = np.ascontiguousarray(
+            pred_confidences.transpose(2, 0, 1)
         )
-        pred_labels = pred_labels.cpu().numpy()
-        pred_confidences = pred_confidences.cpu().numpy()
-        # Resize predicted labels and confidences to original image size
-        for i in range(pred_labels.shape[2]):
-            pred_labels_resized = resize(
-                pred_labels[..., i],
-                (self.img_height, self.img_width),
-                order=0,
-                mode="reflect",
-                anti_aliasing=False,
-                preserve_range=True,
-            )  # order = 0, nearest neighbour
-            pred_labels_resized = pred_labels_resized.astype(np.int)
-            # Add semantic class colors
-            self.semantic_colors[i] = decode_segmap(
-                pred_labels_resized, self.n_classes, self.cmap
+        # Factors taking full-resolution image coordinates onto the low
+        # resolution grid
+        self._lowres_scale = (
+            labels.shape[2] / self.img_width,
+            labels.shape[1] / self.img_height,
+        )
+        # Only pay for the full-resolution upsample + decode when someone
+        # is actually looking at the semantic image
+        self._sem_color0_fresh = self.sem_img_pub.get_num_connections() > 0
+        if self._sem_color0_fresh:
+            cv2.resize(
+                labels[0],
+                (self.img_width, self.img_height),
+                dst=self._labels_resized[0],
+                interpolation=cv2.INTER_NEAREST,
             )
-        for i in range(pred_confidences.shape[2]):
-            self.confidences[i] = resize(
-                pred_confidences[..., i],
-                (self.img_height, self.img_width),
-                mode="reflect",
-                anti_aliasing=True,
-                preserve_range=True,
+            decode_segmap(
+                self._labels_resized[0],
+                self.n_classes,
+                self.cmap,
+                out=self.semantic_colors[0],
             )
 
-    def predict(self, img, flip_channels=True, rotate_180=True):
+    def _preprocess(self, img, flip_channels=True, rotate_180=False):
         """
-        Do semantic segmantation
+        Resize, channel-swap and cast the input into the cached buffers
         \param img: (numpy array bgr8) The input cv image
+        \return (numpy array float32) the CNN-ready image, backed by the
+            cached buffer (overwritten on the next call)
         """
-        img = (
-            img.copy()
-        )  # Make a copy of image because the method will modify the image
         # orig_size = (img.shape[0], img.shape[1]) # Original image size
         # Prepare image: first resize to CNN input size then extract the mean value of SUNRGBD dataset. No normalization
-        img = resize(
+        # INTER_AREA stays in uint8 rather than going through float64.
+        # The resize writes into a cached buffer and leaves the input
+        # untouched, so the old defensive copy is gone.
+        img = cv2.resize(
             img,
-            self.cnn_input_size,
-            mode="reflect",
-            anti_aliasing=True,
-            preserve_range=True,
-        )  # Give float64
+            (self.cnn_input_size[1], self.cnn_input_size[0]),
+            dst=self._resized_u8,
+            interpolation=cv2.INTER_AREA,
+        )
 
-        img = img.astype(np.float32)
         if flip_channels:
-            img = np.flip(img, axis=2)
+            # bgr -> rgb as a SIMD channel swap rather than a
+            # negative-stride view that forces a copy downstream
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=self._rgb_u8)
         if rotate_180:
-            img = np.flip(img, axis=(0, 1))
+            img = cv2.rotate(img, ROTATE_180, dst=self._rot_u8)
+        # Cast into the cached float32 buffer instead of allocating a new
+        # array every frame
+        np.copyto(self._in_f32, img)
+        return self._in_f32
 
-        outputs = inference_segmentor(self.model, img, return_probabilities=True)[0]
+    def predict(self, img, flip_channels=True, rotate_180=False):
+        """
+        Do semantic segmantation
+        \param img: (numpy array bgr8) The input cv image
+        \param rotate_180: (bool) rotate the image before inference and
+            un-rotate the output. Off by default now that the camera
+            rotation is folded into the extrinsics.
+        """
+        img = self._preprocess(img, flip_channels=flip_channels, rotate_180=rotate_180)
+
+        if self._use_trt:
+            outputs = self.model(img)
+        elif self._use_cuda:
+            # Run inference on the dedicated stream so it can overlap the
+            # CPU-side work of neighbouring frames
+            with torch.cuda.stream(self._stream):
+                outputs = inference_segmentor(
+                    self.model, img, return_probabilities=True
+                )[0]
+        else:
+            outputs = inference_segmentor(
+                self.model, img, return_probabilities=True
+            )[0]
 
         if rotate_180:
             outputs = np.flip(outputs, axis=(0, 1))